@@ -12,6 +12,7 @@ frappe.pages['bank_wizard'].on_page_load = function (wrapper) {
 
 frappe.bank_wizard = {
     start: 0,
+    account_defaults: {},
     make: function (page) {
         var me = frappe.bank_wizard;
         me.page = page;
@@ -24,37 +25,54 @@ frappe.bank_wizard = {
             // get selected account
             var account = document.getElementById("bank_account").value;
 
-            // read the file 
-            var file = document.getElementById("input_file").files[0];
-            if (file.name.toLowerCase().endsWith(".xml")) {
-                // this is an xml file
-                var content = "";
-                if (file) {
-                    // create a new reader instance
-                    var reader = new FileReader();
-                    // assign load event to process the file
-                    reader.onload = function (event) {
-                        // enable waiting gif
-                        frappe.bank_wizard.start_wait();
+            frappe.bank_wizard.read_file(function (content) {
+                // enable waiting gif
+                frappe.bank_wizard.start_wait();
 
-                        // read file content
-                        content = event.target.result;
+                // parse the xml content
+                frappe.bank_wizard.parse(content, account);
+            });
+        });
+        this.page.main.find(".btn-export-file").on('click', function () {
+            var account = document.getElementById("bank_account").value;
+            var file_format = $(this).attr("data-format");
 
-                        // parse the xml content
-                        frappe.bank_wizard.parse(content, account);
-                    }
-                    // assign an error handler event
-                    reader.onerror = function (event) {
-                        frappe.msgprint(__("Error reading file"), __("Error"));
+            frappe.bank_wizard.read_file(function (content) {
+                // the export is streamed as a download
+                open_url_post(
+                    '/api/method/erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard.export_camt053',
+                    {
+                        content: content,
+                        bank_account: account,
+                        file_format: file_format
                     }
+                );
+            });
+        });
+    },
+    read_file: function (callback) {
+        // read the file 
+        var file = document.getElementById("input_file").files[0];
+        if (!file) {
+            frappe.msgprint(__("Please select a file."), __("Information"));
+        } else if (file.name.toLowerCase().endsWith(".xml")) {
+            // this is an xml file
+            // create a new reader instance
+            var reader = new FileReader();
+            // assign load event to process the file
+            reader.onload = function (event) {
+                // read file content
+                callback(event.target.result);
+            }
+            // assign an error handler event
+            reader.onerror = function (event) {
+                frappe.msgprint(__("Error reading file"), __("Error"));
+            }
 
-                    reader.readAsText(file, "ANSI");
-                }
-                else {
-                    frappe.msgprint(__("Please select a file."), __("Information"));
-                }
-            } else if (file.name.toLowerCase().endsWith(".zip")) {
-                // this is a zip file
+            reader.readAsText(file, "ANSI");
+        } else if (file.name.toLowerCase().endsWith(".zip")) {
+            // this is a zip file, load the zip extension on first use
+            frappe.require("/assets/erpnext_bank_utils/js/jszip.min.js", function () {
                 console.log("unzipping " + file.name + "...");
                 JSZip.loadAsync(file).then(function (zip) {
                     // async: compile a promise to extract all contained files
@@ -69,58 +87,67 @@ frappe.bank_wizard = {
                     // on completed promise, combine content and process
                     Promise.all(promises).then(function (list) {
                         console.log("Promise complete!");
-                        var content = list.join("");
-                        // parse the xml content
-                        frappe.bank_wizard.parse(content, account);
+                        callback(list.join(""));
                     });
                 }, function (e) {
                     frappe.msgprint(__("Unzip error: ") + e.message, __("Error"));
                 });
-            } else {
-                frappe.msgprint(__("Unsupported file format. Please use an xml or zip camt file"), __("Error"));
-            }
-        });
+            });
+        } else {
+            frappe.msgprint(__("Unsupported file format. Please use an xml or zip camt file"), __("Error"));
+        }
     },
     parse: function (content, account) {
         // call bankimport method with file content
         frappe.call({
             method: 'erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard.read_camt053',
             args: {
-                content: content
+                content: content,
+                bank_account: account,
+                ignore_watermark: document.getElementById("ignore_watermark").checked ? 1 : 0
             },
             callback: function (r) {
                 if (r.message) {
-                    try {
-                        frappe.show_alert(r.message.length + __(" transactions found"));
-                        frappe.bank_wizard.render_response(r.message);
-                    } catch {
-                        frappe.msgprint("An error occurred while parsing. Please check the log files.");
-                        frappe.bank_wizard.end_wait();
-                    }
+                    frappe.bank_wizard.load_account_defaults(r.message, account).then(function () {
+                        try {
+                            frappe.show_alert(r.message.length + __(" transactions found"));
+                            frappe.bank_wizard.render_response(r.message);
+                        } catch {
+                            frappe.msgprint("An error occurred while parsing. Please check the log files.");
+                            frappe.bank_wizard.end_wait();
+                        }
+                    });
                 }
             }
         });
     },
     run: function () {
-        // populate bank accounts
-        frappe.call({
-            method: 'erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard.get_bank_accounts',
-            callback: function (r) {
+        // populate bank accounts and the defaults of the first one in one call
+        // plain GET without cache buster, so that the browser may cache the response
+        $.ajax({
+            url: '/api/method/erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard.get_wizard_data',
+            type: 'GET',
+            dataType: 'json',
+            cache: true,
+            success: function (r) {
                 if (r.message) {
                     var select = document.getElementById("bank_account");
                     // add on change event
                     select.onchange = function () {
                         frappe.bank_wizard.set_defaults(select.value);
                     };
-                    for (var i = 0; i < r.message.length; i++) {
+                    for (var i = 0; i < r.message.bank_accounts.length; i++) {
                         var opt = document.createElement("option");
-                        opt.value = r.message[i];
-                        opt.innerHTML = r.message[i];
+                        opt.value = r.message.bank_accounts[i];
+                        opt.innerHTML = r.message.bank_accounts[i];
                         select.appendChild(opt);
                     }
-                    // call with initial value
-                    frappe.bank_wizard.set_defaults(select.value);
+                    // defaults of the initial value
+                    frappe.bank_wizard.show_defaults(r.message.defaults);
                 }
+            },
+            error: function () {
+                frappe.msgprint(__("The bank accounts could not be loaded."), __("Error"));
             }
         });
     },
@@ -131,18 +158,52 @@ frappe.bank_wizard = {
                 'bank_account': bank_account
             },
             callback: function (r) {
-                if (r.message) {
-                    document.getElementById("company").value = r.message.company;
-                    document.getElementById("default_supplier").value = r.message.default_supplier;
-                    document.getElementById("default_customer").value = r.message.default_customer;
-                    document.getElementById("intermediate_account").value = r.message.intermediate_account;
-                    document.getElementById("payable_account").value = r.message.default_payable_account;
-                    document.getElementById("receivable_account").value = r.message.default_receivable_account;
-                } else {
-                    frappe.msgprint(__("Please set the <b>default accounts</b> in <a href=\"/desk#Form/Company/{0}\">{0}</a>.").replace("{0}", r.message.company));
-                }
+                frappe.bank_wizard.show_defaults(r.message);
+            }
+        });
+    },
+    show_defaults: function (defaults) {
+        if (defaults) {
+            document.getElementById("company").value = defaults.company;
+            document.getElementById("default_supplier").value = defaults.default_supplier;
+            document.getElementById("default_customer").value = defaults.default_customer;
+            document.getElementById("intermediate_account").value = defaults.intermediate_account;
+            document.getElementById("payable_account").value = defaults.default_payable_account;
+            document.getElementById("receivable_account").value = defaults.default_receivable_account;
+        } else {
+            frappe.msgprint(__("Please set the <b>default accounts</b> in <a href=\"/desk#Form/Bank Utils Settings\">Bank Utils Settings</a>."));
+        }
+    },
+    load_account_defaults: function (transactions, account) {
+        // load the defaults of other bank accounts statements were routed to
+        var me = frappe.bank_wizard;
+        var accounts = [];
+        transactions.forEach(function (transaction) {
+            if (transaction.bank_account && transaction.bank_account !== account
+                && !me.account_defaults[transaction.bank_account] && accounts.indexOf(transaction.bank_account) < 0) {
+                accounts.push(transaction.bank_account);
             }
         });
+        return Promise.all(accounts.map(function (bank_account) {
+            return frappe.xcall('erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard.get_defaults', {
+                'bank_account': bank_account
+            }).then(function (defaults) {
+                me.account_defaults[bank_account] = {
+                    'bank_account': bank_account,
+                    'company': defaults.company,
+                    'intermediate_account': defaults.intermediate_account,
+                    'payable_account': defaults.default_payable_account,
+                    'receivable_account': defaults.default_receivable_account,
+                    'default_customer': defaults.default_customer,
+                    'default_supplier': defaults.default_supplier
+                };
+            }, function () {
+                // no defaults for the company, the transactions are shown without them
+                me.account_defaults[bank_account] = {
+                    'bank_account': bank_account
+                };
+            });
+        }));
     },
     start_wait: function () {
         document.getElementById("waitingScreen").classList.remove("hidden");
@@ -158,26 +219,43 @@ frappe.bank_wizard = {
 
         // display the transactions as table
         var container = document.getElementById("table_placeholder");
-        var content = frappe.render_template('transaction_table', { "transactions": transactions });
+        var selected_defaults = {
+            'bank_account': document.getElementById("bank_account").value,
+            'company': document.getElementById("company").value,
+            'intermediate_account': document.getElementById("intermediate_account").value,
+            'payable_account': document.getElementById("payable_account").value,
+            'receivable_account': document.getElementById("receivable_account").value,
+            'default_customer': document.getElementById("default_customer").value,
+            'default_supplier': document.getElementById("default_supplier").value
+        };
+        var content = frappe.render_template('transaction_table', {
+            "transactions": transactions,
+            "bank_account": selected_defaults.bank_account
+        });
         container.innerHTML = content;
 
         // attach button handlers
-        var bank_account = document.getElementById("bank_account").value;
-        var company = document.getElementById("company").value;
-        var intermediate_account = document.getElementById("intermediate_account").value;
-        var payable_account = document.getElementById("payable_account").value;
-        var receivable_account = document.getElementById("receivable_account").value;
-        var default_customer = document.getElementById("default_customer").value;
-        var default_supplier = document.getElementById("default_supplier").value;
-
         transactions.forEach(function (transaction) {
+            // transactions of other bank accounts are booked with their defaults
+            var defaults = frappe.bank_wizard.account_defaults[transaction.bank_account] || selected_defaults;
+            var bank_account = defaults.bank_account;
+            var company = defaults.company;
+            var intermediate_account = defaults.intermediate_account;
+            var payable_account = defaults.payable_account;
+            var receivable_account = defaults.receivable_account;
+            var default_customer = defaults.default_customer;
+            var default_supplier = defaults.default_supplier;
+
             // add generic payables/receivables handler
             const payment = {
                 'amount': transaction.amount,
                 'date': transaction.date,
                 'reference_no': transaction.unique_reference,
                 'remarks': (transaction.transaction_reference + ", " + transaction.party_name + ", " + transaction.party_address),
-                'company': company
+                'company': company,
+                // without exchange rate, the rate of the currency is looked up when booking
+                'exchange_rate': transaction.exchange_rate,
+                'currency': transaction.currency
             };
 
             if (transaction.credit_debit == "DBIT") {
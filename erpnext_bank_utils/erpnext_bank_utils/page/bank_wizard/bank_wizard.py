@@ -2,11 +2,71 @@
 # Copyright (c) 2017-2020, libracore and contributors
 # License: AGPL v3. See LICENCE
 import ast
+import bisect
+import csv
 import hashlib
+import math
+import multiprocessing
+import tempfile
 from bs4 import BeautifulSoup
+from collections import OrderedDict
+from io import StringIO
+from werkzeug.wrappers import Response
 
 import frappe
 from frappe import _
+from frappe.utils import add_days, cint, flt, getdate
+from erpnext_bank_utils.party_memo import get_party_memo, set_party_memo
+
+# statements with fewer transactions are always matched in the current process
+MIN_PARALLEL_TRANSACTIONS = 1000
+# maximum number of values in one `in` filter
+QUERY_BATCH_SIZE = 1000
+# days before a statement for which exchange rates are loaded
+EXCHANGE_RATE_LOOKBACK_DAYS = 31
+# confidence points of each agreement between a transaction and its matches
+CONFIDENCE_WEIGHTS = {
+    'reference': 40,
+    'amount': 30,
+    'party': 20,
+    'iban': 10
+}
+
+# lifetime of the cached bank wizard bootstrap data
+WIZARD_DATA_CACHE_SECONDS = 60
+# statement element of each camt message element
+CAMT_STATEMENT_TAGS = {
+    'bktocstmracctrpt': 'rpt',          # camt.052
+    'bktocstmrstmt': 'stmt',            # camt.053
+    'bktocstmrdbtcdtntfctn': 'ntfctn'   # camt.054
+}
+
+# columns of the transaction export, (label, transaction key)
+EXPORT_COLUMNS = [
+    ("ID", 'txid'),
+    ("Bank Account", 'bank_account'),
+    ("Date", 'date'),
+    ("Currency", 'currency'),
+    ("Amount", 'amount'),
+    ("Debit/Credit", 'credit_debit'),
+    ("Party Name", 'party_name'),
+    ("Party Address", 'party_address'),
+    ("IBAN", 'party_iban'),
+    ("Unique Reference", 'unique_reference'),
+    ("Reference", 'transaction_reference'),
+    ("Party", 'party_match'),
+    ("Employee", 'employee_match'),
+    ("Invoices", 'invoice_matches'),
+    ("Expense Claims", 'expense_matches'),
+    ("Matched Amount", 'matched_amount'),
+    ("Confidence", 'confidence')
+]
+# rows per chunk of a CSV export and bytes per chunk of an XLSX export
+EXPORT_CHUNK_ROWS = 500
+EXPORT_CHUNK_BYTES = 65536
+
+# read-only match snapshot of a matching worker process
+_match_snapshot = None
 
 
 def match_by_amount(amount):
@@ -112,6 +172,29 @@ def get_defaults(bank_account):
     }
 
 
+@frappe.whitelist()
+def get_wizard_data():
+    """Return the bank accounts and the defaults of the first one.
+
+    The response may be cached by the browser for WIZARD_DATA_CACHE_SECONDS,
+    so that reopening the bank wizard does not query the accounts again.
+    """
+    bank_accounts = get_bank_accounts()
+    try:
+        defaults = get_defaults(bank_accounts[0]) if bank_accounts else None
+    except frappe.DoesNotExistError:
+        # no Bank Utils Defaults for the company
+        defaults = None
+
+    wizard_data = {
+        "bank_accounts": bank_accounts,
+        "defaults": defaults
+    }
+    response = Response(frappe.as_json({"message": wizard_data}), mimetype="application/json")
+    response.headers["Cache-Control"] = "private, max-age={0}".format(WIZARD_DATA_CACHE_SECONDS)
+    return response
+
+
 @frappe.whitelist()
 def get_bank_accounts():
     bank_accounts = frappe.get_list('Account', filters={
@@ -123,386 +206,1085 @@ def get_bank_accounts():
 
 
 @frappe.whitelist()
-def read_camt053(content):
+def read_camt053(content, bank_account=None, ignore_watermark=False):
+    """Read camt.052, camt.053 and camt.054 messages in one pass.
+
+    content may contain several messages with any number of statements. The
+    statements are routed to the bank account of their IBAN, statements of an
+    unknown IBAN to bank_account. Transactions carry their `bank_account` and
+    are numbered across all statements.
+    """
     soup = BeautifulSoup(content, 'lxml')
-    entries = soup.find_all('ntry')
+    settings = frappe.get_single("Bank Utils Settings")
 
-    return read_camt_transactions(entries)
+    txns = []
+    for statement_account, entries in get_statement_entries(soup, bank_account):
+        for txn in read_statement(entries, statement_account, settings, ignore_watermark):
+            txn['txid'] = len(txns)
+            txn['bank_account'] = statement_account
+            txns.append(txn)
 
+    return txns
 
-def read_camt_transactions(transaction_entries):
-    txns = []
+
+def get_statement_entries(soup, bank_account=None):
+    """Return a list of (bank account, entries) of all statements in soup.
+
+    The message type is detected from the message element: camt.052 reports
+    (Rpt), camt.053 statements (Stmt) and camt.054 notifications (Ntfctn).
+    Entries of all statements of one bank account are merged in document
+    order. Pending entries of intraday reports are left out.
+
+    bank_account is used for a single statement and for statements without
+    IBAN. Statements of several accounts with an unknown IBAN are reported
+    and skipped, so that they are not booked to the selected account.
+    """
+    statements = []
+    for message in soup.find_all(list(CAMT_STATEMENT_TAGS)):
+        statements.extend(message.find_all(CAMT_STATEMENT_TAGS[message.name], recursive=False))
+    if not statements:
+        # plain list of entries
+        return [(bank_account, soup.find_all('ntry'))]
+
+    statement_ibans = []
+    for statement in statements:
+        try:
+            statement_ibans.append(normalize_iban(statement.find('acct', recursive=False).id.iban.get_text()))
+        except AttributeError:
+            statement_ibans.append(None)
+
+    # IBANs are stored as typed, they are compared without spaces
+    accounts = {}
+    for account in frappe.get_all("Bank Account",
+            filters=[['is_company_account', '=', 1], ['iban', 'is', 'set'], ['account', 'is', 'set']],
+            fields=['iban', 'account']):
+        accounts.setdefault(normalize_iban(account['iban']), account['account'])
+
+    statement_entries = OrderedDict()
+    unknown_ibans = []
+    for statement, iban in zip(statements, statement_ibans):
+        if iban in accounts:
+            statement_account = accounts[iban]
+        elif not iban or len(statements) == 1:
+            statement_account = bank_account
+        else:
+            if iban not in unknown_ibans:
+                unknown_ibans.append(iban)
+            continue
+        entries = statement_entries.setdefault(statement_account, [])
+        for entry in statement.find_all('ntry', recursive=False):
+            status = entry.find('sts', recursive=False)
+            if status and status.get_text().strip() not in ("", "BOOK"):
+                continue
+            entries.append(entry)
+
+    if unknown_ibans:
+        frappe.msgprint(_("No company Bank Account has the IBAN {0}, its statements were skipped.").format(
+            ", ".join(unknown_ibans)), indicator="orange")
+    return list(statement_entries.items())
+
+
+def read_statement(entries, bank_account, settings, ignore_watermark=False):
+    """Read, match and auto-reconcile the entries of one bank account."""
+    company = frappe.get_cached_value("Account", bank_account, "company") if bank_account else None
+    watermark = get_watermark(settings, bank_account) if bank_account else None
+    if watermark and not cint(ignore_watermark):
+        entries = skip_watermarked_entries(entries, watermark)
+
+    txns = read_camt_transactions(entries, company=company)
+
+    if bank_account and settings.auto_reconcile:
+        txns = auto_reconcile_transactions(txns, bank_account, settings.auto_reconcile_threshold)
+
+    if bank_account:
+        update_watermark(settings, bank_account, entries, txns)
+
+    return txns
+
+
+def get_entry_booking(entry):
+    """Return (booking date, AcctSvcrRef) of an <Ntry>."""
+    try:
+        account_service_reference = entry.acctsvcrref.get_text()
+    except:
+        account_service_reference = ""
+    return get_booking_date(entry), account_service_reference
+
+
+def get_booking_date(entry):
+    """Return the booking date of an <Ntry> from BookgDt/Dt or BookgDt/DtTm.
+
+    Intraday reports often only carry the date and time of the booking.
+    """
+    booking_date = entry.bookgdt.find(['dt', 'dttm'])
+    return booking_date.get_text().strip()[:10]
+
+
+def get_watermark(settings, bank_account):
+    """Return the watermark row of bank_account or None."""
+    for watermark in settings.get('watermarks') or []:
+        if watermark.bank_account == bank_account:
+            return watermark
+    return None
+
+
+def skip_watermarked_entries(entries, watermark):
+    """Drop entries booked before the watermark.
+
+    On the watermark date, only the entries up to the watermark entry in
+    statement order are dropped. The statement the watermark was set from may
+    not have covered the whole day, e.g. a camt.054 notification or camt.052
+    intraday report, so later entries of that date are kept. If the statement
+    does not contain the watermark entry, all entries of that date are kept.
+    """
+    watermark_date = getdate(watermark.booking_date).isoformat()
+    bookings = [get_entry_booking(entry) for entry in entries]
+    watermark_position = -1
+    if watermark.account_servicer_reference:
+        watermark_booking = (watermark_date, watermark.account_servicer_reference)
+        if watermark_booking in bookings:
+            watermark_position = bookings.index(watermark_booking)
+
+    return [entry for position, (entry, (date, reference)) in enumerate(zip(entries, bookings))
+        if date > watermark_date or (date == watermark_date and position > watermark_position)]
+
+
+def update_watermark(settings, bank_account, entries, txns):
+    """Advance the watermark of bank_account after reading a statement.
+
+    txns are the transactions which are not recorded yet. All entries booked
+    before the first of them are recorded, the newest of these entries becomes
+    the watermark. The watermark never moves backwards and is only stored for
+    users who may change the Bank Utils Settings.
+    """
+    if not frappe.has_permission("Bank Utils Settings", "write"):
+        return
+
+    bookings = [get_entry_booking(entry) for entry in entries]
+    if txns:
+        cutoff = min(txn['date'] for txn in txns)
+        bookings = [booking for booking in bookings if booking[0] < cutoff]
+    if not bookings:
+        return
+
+    booking_date = max(date for date, reference in bookings)
+    # the last entry of the newest booking date in statement order
+    reference = [reference for date, reference in bookings if date == booking_date][-1]
+
+    watermark = get_watermark(settings, bank_account)
+    if watermark and watermark.booking_date and getdate(watermark.booking_date).isoformat() >= booking_date:
+        return
+    # only the watermark row is written, not the whole settings document
+    if watermark:
+        frappe.db.set_value("Bank Utils Watermark", watermark.name, {
+            'booking_date': booking_date,
+            'account_servicer_reference': reference
+        }, update_modified=False)
+        watermark.booking_date = booking_date
+        watermark.account_servicer_reference = reference
+    else:
+        watermark = settings.append('watermarks', {
+            'bank_account': bank_account,
+            'booking_date': booking_date,
+            'account_servicer_reference': reference
+        })
+        watermark.db_insert()
+
+
+def read_camt_transactions(transaction_entries, processes=None, company=None):
+    """Parse camt entries and match the new transactions to parties and documents.
+
+    Matching runs against a read-only snapshot of the open documents and
+    parties. With more than one process, the transactions are split into
+    chunks which are matched in parallel and merged back in statement order.
+    """
+    if processes is None:
+        processes = cint(frappe.db.get_single_value("Bank Utils Settings", "matching_processes"))
+
+    parsed_txns = []
     for entry in transaction_entries:
-        date = entry.bookgdt.dt.get_text()
-        transactions = entry.find_all('txdtls')
-        # fetch entry amount as fallback
-        entry_amount = float(entry.amt.get_text())
-        entry_currency = entry.amt['ccy']
-        # fetch global account service reference
+        parsed_txns.extend(read_camt_entry(entry))
+
+    txns = skip_imported_transactions(parsed_txns)
+    snapshot = get_match_snapshot(txns, company)
+
+    if processes > 1 and len(txns) >= MIN_PARALLEL_TRANSACTIONS:
+        chunk_size = int(math.ceil(len(txns) / float(processes * 4)))
+        chunks = [txns[i:i + chunk_size] for i in range(0, len(txns), chunk_size)]
+        pool = multiprocessing.Pool(processes, initializer=init_match_worker, initargs=(snapshot,))
         try:
-            global_account_service_reference = entry.acctsvcrref.get_text()
-        except:
-            global_account_service_reference = ""
-        transaction_count = 0
-        if transactions and len(transactions) > 0:
-            for transaction in transactions:
-                transaction_count += 1
-                # --- find transaction type: paid or received: (DBIT: paid, CRDT: received)
-                try:
-                    credit_debit = transaction.cdtdbtind.get_text()
-                except:
-                    # fallback to entry indicator
-                    credit_debit = entry.cdtdbtind.get_text()
+            results = pool.map(match_transaction_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return [txn for chunk in results for txn in chunk]
+
+    return [match_transaction(txn, snapshot) for txn in txns]
+
+
+def init_match_worker(snapshot):
+    global _match_snapshot
+    _match_snapshot = snapshot
+
 
-                # --- find unique reference
+def match_transaction_chunk(chunk):
+    """Match a chunk of transactions in a worker process.
+
+    Workers must not access the database, they only use the snapshot.
+    """
+    return [match_transaction(txn, _match_snapshot) for txn in chunk]
+
+
+def skip_imported_transactions(parsed_txns):
+    """Drop transactions which are already recorded and number the others."""
+    imported_references = get_imported_references([txn['unique_reference'] for txn in parsed_txns])
+
+    txns = []
+    for txn in parsed_txns:
+        if txn['unique_reference'] in imported_references:
+            frappe.log_error("Transaction {0} is already imported in {1}.".format(
+                txn['unique_reference'], imported_references[txn['unique_reference']]))
+        else:
+            txn['txid'] = len(txns)
+            txns.append(txn)
+    return txns
+
+
+def get_imported_references(references):
+    """Return a dict reference_no: Payment Entry of the recorded references."""
+    imported_references = {}
+    for payment_entry in get_all_in('Payment Entry', 'reference_no', references, fields=['name', 'reference_no']):
+        imported_references.setdefault(payment_entry['reference_no'], payment_entry['name'])
+    return imported_references
+
+
+def get_all_in(doctype, fieldname, values, filters=None, fields=None):
+    """Like frappe.get_all with an `in` filter on fieldname, in batches."""
+    values = list(set(values))
+    result = []
+    for i in range(0, len(values), QUERY_BATCH_SIZE):
+        batch_filters = [[fieldname, 'in', values[i:i + QUERY_BATCH_SIZE]]] + (filters or [])
+        result.extend(frappe.get_all(doctype, filters=batch_filters, fields=fields))
+    return result
+
+
+def parse_payment_instruction_id(payment_instruction_id):
+    """Return (payment proposal, row idx) of PMTINF-[payment proposal]-row."""
+    payment_instruction_fields = payment_instruction_id.split("-")
+    payment_instruction_row = int(payment_instruction_fields[-1]) + 1
+    payment_proposal_id = payment_instruction_fields[1]
+    return payment_proposal_id, payment_instruction_row
+
+
+def normalize_iban(iban):
+    """Return iban without spaces in upper case, for comparing IBANs."""
+    return (iban or "").replace(" ", "").upper()
+
+
+def get_match_snapshot(txns, company=None):
+    """Load the open documents and parties needed to match the transactions."""
+    return load_match_snapshot(get_match_keys(txns), company)
+
+
+def get_match_keys(txns, keys=None):
+    """Collect the values of the transactions a match snapshot is loaded for.
+
+    Pass keys to add the transactions of another batch.
+    """
+    if keys is None:
+        keys = {
+            'party_names': set(),
+            'payment_instructions': set(),
+            'party_ibans': set(),
+            'party_signatures': set(),
+            'currencies': set(),
+            'dates': set()
+        }
+    for txn in txns:
+        if txn.get('party_name'):
+            keys['party_names'].add(txn['party_name'])
+        if txn.get('payment_instruction'):
+            keys['payment_instructions'].add(txn['payment_instruction'])
+        if txn.get('party_iban'):
+            keys['party_ibans'].add(normalize_iban(txn['party_iban']))
+        if txn.get('party_name'):
+            keys['party_signatures'].add((txn['party_name'], normalize_iban(txn.get('party_iban'))))
+        keys['currencies'].add(txn['currency'])
+        keys['dates'].add(txn['date'])
+    return keys
+
+
+def load_match_snapshot(keys, company=None):
+    """Load the open documents and parties for the keys of get_match_keys.
+
+    Parties are only loaded for names which occur in the transactions, exchange
+    rates only for the date range of the transactions. The snapshot consists of
+    plain python types, so that it can be passed to the matching worker
+    processes.
+
+    Parties of recurring counterparties are taken from the party memo, only the
+    names and IBANs missing in the memo are queried.
+    """
+    party_memo = get_party_memo(keys['party_names'])
+    party_names = set(keys['party_names']) - set(party_memo)
+    party_ibans_missing = set(keys['party_ibans']) - set(
+        iban for name, iban in keys['party_signatures']
+        if name in party_memo and iban in party_memo[name]['ibans'])
+    payment_instructions = keys['payment_instructions']
+
+    payment_proposal_payments = {}
+    if payment_instructions:
+        try:
+            proposal_payments = get_all_in("Payment Proposal Payment", 'parent',
+                [proposal for proposal, row in payment_instructions],
+                fields=['parent', 'idx', 'receiver', 'receiver_address_line1', 'receiver_address_line2', 'iban', 'reference'])
+        except Exception:
+            # payment proposals are not available
+            proposal_payments = []
+        for payment in proposal_payments:
+            payment_proposal_payments[(payment['parent'], payment['idx'])] = dict(payment)
+            party_names.add(payment['receiver'])
+
+    suppliers = {}
+    proposal_suppliers = {}
+    for supplier in get_all_in("Supplier", 'supplier_name', party_names,
+            fields=['name', 'supplier_name', 'disabled']):
+        proposal_suppliers.setdefault(supplier['supplier_name'], supplier['name'])
+        if not supplier['disabled']:
+            suppliers.setdefault(supplier['supplier_name'], supplier['name'])
+
+    customers = {}
+    for customer in get_all_in("Customer", 'customer_name', party_names,
+            filters=[['disabled', '=', 0]], fields=['name', 'customer_name']):
+        customers.setdefault(customer['customer_name'], customer['name'])
+
+    employees = {}
+    for employee in get_all_in("Employee", 'employee_name', party_names,
+            filters=[['status', '=', 'Active']], fields=['name', 'employee_name']):
+        employees.setdefault(employee['employee_name'], employee['name'])
+
+    purchase_invoices = [dict(pinv) for pinv in frappe.get_all("Purchase Invoice",
+        filters=[['docstatus', '=', 1], ['outstanding_amount', '>', 0]],
+        fields=['name', 'supplier', 'outstanding_amount', 'bill_no', 'grand_total', 'party_account_currency'])]
+    sales_invoices = [dict(sinv) for sinv in frappe.get_all("Sales Invoice",
+        filters=[['outstanding_amount', '>', 0]],
+        fields=['name', 'customer', 'outstanding_amount', 'party_account_currency'])]
+    expense_claims = [dict(exp) for exp in frappe.get_all("Expense Claim",
+        filters=[['docstatus', '=', 1], ['status', '=', 'Unpaid']],
+        fields=['name', 'employee', 'total_claimed_amount'])]
+
+    company_currency = frappe.get_cached_value("Company", company, "default_currency") if company else None
+    currencies = set(keys['currencies'])
+    currencies.update(inv['party_account_currency'] for inv in purchase_invoices + sales_invoices)
+    if company_currency:
+        currencies.add(company_currency)
+    currencies.discard(None)
+    if len(currencies) > 1 and keys['dates']:
+        exchange_rates = get_exchange_rates(currencies, min(keys['dates']), max(keys['dates']))
+    else:
+        exchange_rates = {}
+
+    party_ibans = {}
+    if party_ibans_missing:
+        # IBANs are stored as typed, they are compared without spaces
+        for bank_account in frappe.get_all("Bank Account",
+                filters=[['party', 'is', 'set'], ['iban', 'is', 'set']], fields=['iban', 'party_type', 'party']):
+            iban = normalize_iban(bank_account['iban'])
+            if iban in party_ibans_missing:
+                party_ibans.setdefault(iban, (bank_account['party_type'], bank_account['party']))
+
+    update_party_memo(party_memo, keys['party_signatures'], suppliers, customers, employees, party_ibans)
+
+    return {
+        'suppliers': suppliers,
+        'proposal_suppliers': proposal_suppliers,
+        'customers': customers,
+        'employees': employees,
+        'purchase_invoices': purchase_invoices,
+        'purchase_invoice_totals': {pinv['name']: pinv['grand_total'] for pinv in purchase_invoices},
+        'sales_invoices': sales_invoices,
+        'expense_claims': expense_claims,
+        'payment_proposal_payments': payment_proposal_payments,
+        'party_ibans': party_ibans,
+        'company_currency': company_currency,
+        'exchange_rates': exchange_rates
+    }
+
+
+def update_party_memo(party_memo, signatures, suppliers, customers, employees, party_ibans):
+    """Add the parties of the memo to the maps and memoize the queried ones.
+
+    A counterparty signature is the pair of name and IBAN of a transaction.
+    """
+    for name, entry in party_memo.items():
+        for party_map, party_type in ((suppliers, "Supplier"), (customers, "Customer"), (employees, "Employee")):
+            if entry['parties'].get(party_type):
+                party_map.setdefault(name, entry['parties'][party_type])
+        for iban, party in entry['ibans'].items():
+            if party:
+                party_ibans.setdefault(iban, party)
+
+    entries = {}
+    for name, iban in signatures:
+        entry = entries.get(name) or party_memo.get(name) or {
+            'parties': {
+                "Supplier": suppliers.get(name),
+                "Customer": customers.get(name),
+                "Employee": employees.get(name)
+            },
+            'ibans': {}
+        }
+        if iban:
+            entry['ibans'].setdefault(iban, party_ibans.get(iban))
+        entries[name] = entry
+    set_party_memo(entries)
+
+
+def get_exchange_rates(currencies, from_date, to_date):
+    """Load all Currency Exchange records between the currencies in bulk.
+
+    Return a dict (from_currency, to_currency): [(date, exchange_rate), ...]
+    sorted by date. Records up to EXCHANGE_RATE_LOOKBACK_DAYS before from_date
+    are included, so that the first days of a statement have a rate as well.
+    """
+    records = frappe.get_all("Currency Exchange",
+        filters=[
+            ['from_currency', 'in', list(currencies)],
+            ['to_currency', 'in', list(currencies)],
+            ['date', '>=', add_days(from_date, -EXCHANGE_RATE_LOOKBACK_DAYS)],
+            ['date', '<=', to_date]
+        ],
+        fields=['date', 'from_currency', 'to_currency', 'exchange_rate'],
+        order_by='date asc')
+
+    exchange_rates = {}
+    for record in records:
+        exchange_rates.setdefault((record['from_currency'], record['to_currency']), []).append(
+            (getdate(record['date']).isoformat(), flt(record['exchange_rate'])))
+    return exchange_rates
+
+
+def get_cached_exchange_rate(snapshot, from_currency, to_currency, date):
+    """Return the latest exchange rate on or before date from the snapshot.
+
+    Inverse records are used as well as a conversion via the company currency.
+    Return None if no exchange rate is known.
+    """
+    if from_currency == to_currency:
+        return 1.0
+
+    def lookup(from_currency, to_currency):
+        rates = snapshot['exchange_rates'].get((from_currency, to_currency))
+        if rates:
+            i = bisect.bisect_right(rates, (date, float('inf')))
+            if i:
+                return rates[i - 1][1]
+        rates = snapshot['exchange_rates'].get((to_currency, from_currency))
+        if rates:
+            i = bisect.bisect_right(rates, (date, float('inf')))
+            if i and rates[i - 1][1]:
+                return 1.0 / rates[i - 1][1]
+        return None
+
+    exchange_rate = lookup(from_currency, to_currency)
+    company_currency = snapshot['company_currency']
+    if exchange_rate is None and company_currency and company_currency not in (from_currency, to_currency):
+        from_rate = lookup(from_currency, company_currency)
+        to_rate = lookup(to_currency, company_currency)
+        if from_rate and to_rate:
+            exchange_rate = from_rate / to_rate
+    return exchange_rate
+
+
+def convert_outstanding_amount(snapshot, amount, from_currency, to_currency, date):
+    """Convert an outstanding amount to the transaction currency.
+
+    Return None if no exchange rate is known.
+    """
+    if not from_currency or from_currency == to_currency:
+        return float(amount)
+    exchange_rate = get_cached_exchange_rate(snapshot, from_currency, to_currency, date)
+    if exchange_rate is None:
+        return None
+    return round(float(amount) * exchange_rate, 2)
+
+
+def add_matched_amount(matched_amount, amount):
+    """Add a converted amount, the sum is unknown (None) if any amount is."""
+    if matched_amount is None or amount is None:
+        return None
+    return matched_amount + amount
+
+
+def read_camt_entry(entry):
+    """Parse one <Ntry> into a list of transactions.
+
+    Transactions without TxDtls carry their `payment_instruction` for matching.
+    """
+    txns = []
+    date = get_booking_date(entry)
+    transactions = entry.find_all('txdtls')
+    # fetch entry amount as fallback
+    entry_amount = float(entry.amt.get_text())
+    entry_currency = entry.amt['ccy']
+    # fetch global account service reference
+    try:
+        global_account_service_reference = entry.acctsvcrref.get_text()
+    except:
+        global_account_service_reference = ""
+    transaction_count = 0
+    if transactions and len(transactions) > 0:
+        for transaction in transactions:
+            transaction_count += 1
+            # --- find transaction type: paid or received: (DBIT: paid, CRDT: received)
+            try:
+                credit_debit = transaction.cdtdbtind.get_text()
+            except:
+                # fallback to entry indicator
+                credit_debit = entry.cdtdbtind.get_text()
+
+            # --- find unique reference
+            try:
+                # try to use the account service reference 
+                # unique_reference = transaction.refs.acctsvcrref.get_text()
+                unique_reference = transaction.refs.endtoendid.get_text()
+            except:
+                # fallback: use tx id
                 try:
-                    # try to use the account service reference 
-                    # unique_reference = transaction.refs.acctsvcrref.get_text()
-                    unique_reference = transaction.refs.endtoendid.get_text()
+                    unique_reference = transaction.txid.get_text()
                 except:
-                    # fallback: use tx id
+                    # fallback to pmtinfid
                     try:
-                        unique_reference = transaction.txid.get_text()
+                        unique_reference = transaction.pmtinfid.get_text()
                     except:
-                        # fallback to pmtinfid
-                        try:
-                            unique_reference = transaction.pmtinfid.get_text()
-                        except:
-                            # fallback to group account service reference plus transaction_count
-                            if global_account_service_reference != "":
-                                unique_reference = "{0}-{1}".format(global_account_service_reference, transaction_count)
-                            else:
-                                # fallback to ustrd (do not use)
-                                # unique_reference = transaction.ustrd.get_text()
-                                # fallback to hash
-                                amount = transaction.amt.get_text()
-                                party = transaction.nm.get_text()
-                                code = "{0}:{1}:{2}".format(date, amount, party)
-                                frappe.log_error("Code: {0}".format(code))
-                                unique_reference = hashlib.md5(code.encode("utf-8")).hexdigest()
-                # --- find amount and currency
+                        # fallback to group account service reference plus transaction_count
+                        if global_account_service_reference != "":
+                            unique_reference = "{0}-{1}".format(global_account_service_reference, transaction_count)
+                        else:
+                            # fallback to ustrd (do not use)
+                            # unique_reference = transaction.ustrd.get_text()
+                            # fallback to hash
+                            amount = transaction.amt.get_text()
+                            party = transaction.nm.get_text()
+                            code = "{0}:{1}:{2}".format(date, amount, party)
+                            unique_reference = hashlib.md5(code.encode("utf-8")).hexdigest()
+            # --- find amount and currency
+            try:
+                # try to find as <TxAmt>
+                amount = float(transaction.txamt.amt.get_text())
+                currency = transaction.txamt.amt['ccy']
+            except:
                 try:
-                    # try to find as <TxAmt>
-                    amount = float(transaction.txamt.amt.get_text())
-                    currency = transaction.txamt.amt['ccy']
+                    # fallback to pure <AMT>
+                    amount = float(transaction.amt.get_text())
+                    currency = transaction.amt['ccy']
                 except:
+                    # fallback to amount from entry level
+                    amount = entry_amount
+                    currency = entry_currency
+            try:
+                # --- find party IBAN
+                if credit_debit == "DBIT":
+                    # use RltdPties:Cdtr
+                    party_soup = transaction.rltdpties.cdtr
                     try:
-                        # fallback to pure <AMT>
-                        amount = float(transaction.amt.get_text())
-                        currency = transaction.amt['ccy']
+                        party_iban = transaction.cdtracct.id.iban.get_text()
                     except:
-                        # fallback to amount from entry level
-                        amount = entry_amount
-                        currency = entry_currency
+                        party_iban = ""
+                else:
+                    # CRDT: use RltdPties:Dbtr
+                    party_soup = transaction.rltdpties.dbtr
+                    try:
+                        party_iban = transaction.dbtracct.id.iban.get_text()
+                    except:
+                        party_iban = ""
                 try:
-                    # --- find party IBAN
-                    if credit_debit == "DBIT":
-                        # use RltdPties:Cdtr
-                        party_soup = transaction.rltdpties.cdtr
+                    party_name = party_soup.nm.get_text()
+                    if party_soup.strtnm:
+                        # parse by street name, ...
                         try:
-                            party_iban = transaction.cdtracct.id.iban.get_text()
+                            street = party_soup.strtnm.get_text()
+                            try:
+                                street_number = party_soup.bldgnb.get_text()
+                                address_line1 = "{0} {1}".format(street, street_number)
+                            except:
+                                address_line1 = street
+                                
                         except:
-                            party_iban = ""
-                    else:
-                        # CRDT: use RltdPties:Dbtr
-                        party_soup = transaction.rltdpties.dbtr
+                            address_line1 = ""
                         try:
-                            party_iban = transaction.dbtracct.id.iban.get_text()
+                            plz = party_soup.pstcd.get_text()
                         except:
-                            party_iban = ""
-                    try:
-                        party_name = party_soup.nm.get_text()
-                        if party_soup.strtnm:
-                            # parse by street name, ...
-                            try:
-                                street = party_soup.strtnm.get_text()
-                                try:
-                                    street_number = party_soup.bldgnb.get_text()
-                                    address_line1 = "{0} {1}".format(street, street_number)
-                                except:
-                                    address_line1 = street
-                                    
-                            except:
-                                address_line1 = ""
-                            try:
-                                plz = party_soup.pstcd.get_text()
-                            except:
-                                plz = ""
-                            try:
-                                town = party_soup.twnnm.get_text()
-                            except:
-                                town = ""
-                            address_line2 = "{0} {1}".format(plz, town)
-                        else:
-                            # parse by address lines
-                            address_lines = party_soup.find_all("adrline")
-                            if len(address_lines) == 2:
-                                address_line1 = address_lines[0].get_text()
-                                address_line2 = address_lines[1].get_text()
-                            else:
-                                # in case no address is provided
-                                address_line1 = ""
-                                address_line2 = ""                      
-                    except:
-                        # party is not defined (e.g. DBIT from Bank)
+                            plz = ""
                         try:
-                            # this is a fallback for ZKB which does not provide nm tag, but address line
-                            address_lines = party_soup.find_all("adrline")
-                            party_name = address_lines[0].get_text()
+                            town = party_soup.twnnm.get_text()
                         except:
-                            party_name = "not found"
-                        address_line1 = ""
-                        address_line2 = ""
+                            town = ""
+                        address_line2 = "{0} {1}".format(plz, town)
+                    else:
+                        # parse by address lines
+                        address_lines = party_soup.find_all("adrline")
+                        if len(address_lines) == 2:
+                            address_line1 = address_lines[0].get_text()
+                            address_line2 = address_lines[1].get_text()
+                        else:
+                            # in case no address is provided
+                            address_line1 = ""
+                            address_line2 = ""                      
+                except:
+                    # party is not defined (e.g. DBIT from Bank)
                     try:
-                        country = party_soup.ctry.get_text()
+                        # this is a fallback for ZKB which does not provide nm tag, but address line
+                        address_lines = party_soup.find_all("adrline")
+                        party_name = address_lines[0].get_text()
                     except:
-                        country = ""
-                    if (address_line1 != "") and (address_line2 != ""):
-                        party_address = "{0}, {1}, {2}".format(
-                            address_line1,
-                            address_line2,
-                            country)
-                    elif (address_line1 != ""):
-                        party_address = "{0}, {1}".format(address_line1, country)
-                    else:
-                        party_address = "{0}".format(country)
+                        party_name = "not found"
+                    address_line1 = ""
+                    address_line2 = ""
+                try:
+                    country = party_soup.ctry.get_text()
                 except:
-                    # key related parties not found / no customer info
-                    party_name = ""
-                    party_address = ""
-                    party_iban = ""
+                    country = ""
+                if (address_line1 != "") and (address_line2 != ""):
+                    party_address = "{0}, {1}, {2}".format(
+                        address_line1,
+                        address_line2,
+                        country)
+                elif (address_line1 != ""):
+                    party_address = "{0}, {1}".format(address_line1, country)
+                else:
+                    party_address = "{0}".format(country)
+            except:
+                # key related parties not found / no customer info
+                party_name = ""
+                party_address = ""
+                party_iban = ""
 
+            try:
+                # try to find ESR reference
+                transaction_reference = transaction.rmtinf.strd.cdtrrefinf.ref.get_text()
+            except:
                 try:
-                    # try to find ESR reference
-                    transaction_reference = transaction.rmtinf.strd.cdtrrefinf.ref.get_text()
+                    # try to find a user-defined reference (e.g. SINV.)
+                    transaction_reference = transaction.rmtinf.ustrd.get_text()
                 except:
                     try:
-                        # try to find a user-defined reference (e.g. SINV.)
-                        transaction_reference = transaction.rmtinf.ustrd.get_text()
+                        # try to find an end-to-end ID
+                        transaction_reference = transaction.endtoendid.get_text() 
                     except:
                         try:
-                            # try to find an end-to-end ID
-                            transaction_reference = transaction.endtoendid.get_text() 
+                            # try to find an AddtlTxInf
+                            transaction_reference = transaction.addtltxinf.get_text() 
                         except:
-                            try:
-                                # try to find an AddtlTxInf
-                                transaction_reference = transaction.addtltxinf.get_text() 
-                            except:
-                                transaction_reference = unique_reference
+                            transaction_reference = unique_reference
 
-                # check if this transaction is already recorded
-                match_payment_entry = frappe.get_all('Payment Entry', filters={'reference_no': unique_reference}, fields=['name'])
-                if match_payment_entry:
-                    frappe.log_error("Transaction {0} is already imported in {1}.".format(unique_reference, match_payment_entry[0]['name']))
-                else:
-                    # try to find matching parties & invoices
-                    party_match = None
-                    employee_match = None
-                    invoice_matches = None
-                    expense_matches = None
-                    matched_amount = 0.0
-                    if credit_debit == "DBIT":
-                        # suppliers 
-                        match_suppliers = frappe.get_all("Supplier", 
-                            filters={'supplier_name': party_name, 'disabled': 0}, 
-                            fields=['name'])
-                        if match_suppliers:
-                            party_match = match_suppliers[0]['name']
-                            # restrict pins to supplier
-                            possible_pinvs = frappe.get_all("Purchase Invoice",
-                                filters=[['docstatus', '=', 1], ['outstanding_amount', '>', 0], ['supplier', '=', party_match]],
-                                fields=['name', 'supplier', 'outstanding_amount', 'bill_no'])
-                        else:
-                            # purchase invoices
-                            possible_pinvs = frappe.get_all("Purchase Invoice", 
-                                filters=[['docstatus', '=', 1], ['outstanding_amount', '>', 0]], 
-                                fields=['name', 'supplier', 'outstanding_amount', 'bill_no'])
-                        if possible_pinvs:
-                            invoice_matches = []
-                            for pinv in possible_pinvs:
-                                if pinv['name'] in transaction_reference or (pinv['bill_no'] or pinv['name']) in transaction_reference:
-                                    invoice_matches.append(pinv['name'])
-                                    # override party match in case there is one from the sales invoice
-                                    party_match = pinv['supplier']
-                                    # add total matched amount
-                                    matched_amount += float(pinv['outstanding_amount'])
-                        # employees 
-                        match_employees = frappe.get_all("Employee", 
-                            filters={'employee_name': party_name, 'status': 'active'}, 
-                            fields=['name'])
-                        if match_employees:
-                            employee_match = match_employees[0]['name']
-                        # expense claims
-                        possible_expenses = frappe.get_all("Expense Claim", 
-                            filters=[['docstatus', '=', 1], ['status', '=', 'Unpaid']], 
-                            fields=['name', 'employee', 'total_claimed_amount'])
-                        if possible_expenses:
-                            expense_matches = []
-                            for exp in possible_expenses:
-                                if exp['name'] in transaction_reference:
-                                    expense_matches.append(exp['name'])
-                                    # override party match in case there is one from the sales invoice
-                                    employee_match = exp['employee']
-                                    # add total matched amount
-                                    matched_amount += float(exp['total_claimed_amount'])            
-                    else:
-                        # customers & sales invoices
-                        match_customers = frappe.get_all("Customer", filters={'customer_name': party_name, 'disabled': 0}, fields=['name'])
-                        if match_customers:
-                            party_match = match_customers[0]['name']
-                        # sales invoices
-                        possible_sinvs = frappe.get_all("Sales Invoice", filters=[['outstanding_amount', '>', 0]], fields=['name', 'customer', 'outstanding_amount'])
-                        if possible_sinvs:
-                            invoice_matches = []
-                            for sinv in possible_sinvs:
-                                if sinv['name'] in transaction_reference:
-                                    invoice_matches.append(sinv['name'])
-                                    # override party match in case there is one from the sales invoice
-                                    party_match = sinv['customer']
-                                    # add total matched amount
-                                    matched_amount += float(sinv['outstanding_amount'])
-                                    
-                    # reset invoice matches in case there are no matches
-                    try:
-                        if len(invoice_matches) == 0:
-                            invoice_matches = None
-                        if len(expense_matches) == 0:
-                            expense_matches = None                            
-                    except:
-                        pass                                                                                                
-                    new_txn = {
-                        'txid': len(txns),
-                        'date': date,
-                        'currency': currency,
-                        'amount': amount,
-                        'party_name': party_name,
-                        'party_address': party_address,
-                        'credit_debit': credit_debit,
-                        'party_iban': party_iban,
-                        'unique_reference': unique_reference,
-                        'transaction_reference': transaction_reference,
-                        'party_match': party_match,
-                        'invoice_matches': invoice_matches,
-                        'matched_amount': matched_amount,
-                        'employee_match': employee_match,
-                        'expense_matches': expense_matches
-                    }
-                    txns.append(new_txn)
-        else:
-            # transaction without TxDtls: occurs at CS when transaction is from a pain.001 instruction
-            # get unique ID
+            txns.append({
+                'txid': None,
+                'date': date,
+                'currency': currency,
+                'amount': amount,
+                'party_name': party_name,
+                'party_address': party_address,
+                'credit_debit': credit_debit,
+                'party_iban': party_iban,
+                'unique_reference': unique_reference,
+                'transaction_reference': transaction_reference
+            })
+    else:
+        # transaction without TxDtls: occurs at CS when transaction is from a pain.001 instruction
+        # get unique ID
+        try:
+            unique_reference = entry.acctsvcrref.get_text()
+        except:
+            # fallback: use tx id
             try:
-                unique_reference = entry.acctsvcrref.get_text()
+                unique_reference = entry.txid.get_text()
             except:
-                # fallback: use tx id
+                # fallback to pmtinfid
                 try:
-                    unique_reference = entry.txid.get_text()
+                    unique_reference = entry.pmtinfid.get_text()
                 except:
-                    # fallback to pmtinfid
-                    try:
-                        unique_reference = entry.pmtinfid.get_text()
-                    except:
-                        # fallback to hash
-                        code = "{0}:{1}:{2}".format(date, entry_currency, entry_amount)
-                        unique_reference = hashlib.md5(code.encode("utf-8")).hexdigest()
-            # check if this transaction is already recorded
-            match_payment_entry = frappe.get_all('Payment Entry', filters={'reference_no': unique_reference}, fields=['name'])
-            if match_payment_entry:
-                frappe.log_error("Transaction {0} is already imported in {1}.".format(unique_reference, match_payment_entry[0]['name']))
-            else:
-                # --- find transaction type: paid or received: (DBIT: paid, CRDT: received)
-                credit_debit = entry.cdtdbtind.get_text()
-                # find payment instruction ID
-                try:
-                    payment_instruction_id = entry.pmtinfid.get_text()     # instruction ID, PMTINF-[payment proposal]-row
-                    payment_instruction_fields = payment_instruction_id.split("-")
-                    payment_instruction_row = int(payment_instruction_fields[-1]) + 1
-                    payment_proposal_id = payment_instruction_fields[1]
-                    # find original instruction record
-                    payment_proposal_payments = frappe.get_all("Payment Proposal Payment", 
-                        filters={'parent': payment_proposal_id, 'idx': payment_instruction_row},
-                        fields=['receiver', 'receiver_address_line1', 'receiver_address_line2', 'iban', 'reference'])
-                    # suppliers 
-                    party_match = None
-                    if payment_proposal_payments:
-                        match_suppliers = frappe.get_all("Supplier", filters={'supplier_name': payment_proposal_payments[0]['receiver']}, 
-                            fields=['name'])
-                        if match_suppliers:
-                            party_match = match_suppliers[0]['name']
-                    # purchase invoices 
-                    invoice_match = None
-                    matched_amount = 0
-                    if payment_proposal_payments:
-                        match_invoices = frappe.get_all("Purchase Invoice", 
-                            filters=[['name', '=', payment_proposal_payments[0]['reference']], ['outstanding_amount', '>', 0]], 
-                            fields=['name', 'grand_total'])
-                        if match_invoices:
-                            invoice_match = [match_invoices[0]['name']]
-                            matched_amount = match_invoices[0]['grand_total']
-                    if payment_proposal_payments:
-                        new_txn = {
-                            'txid': len(txns),
-                            'date': date,
-                            'currency': entry_currency,
-                            'amount': entry_amount,
-                            'party_name': payment_proposal_payments[0]['receiver'],
-                            'party_address': "{0}, {1}".format(
-                                payment_proposal_payments[0]['receiver_address_line1'], 
-                                payment_proposal_payments[0]['receiver_address_line2']),
-                            'credit_debit': credit_debit,
-                            'party_iban': payment_proposal_payments[0]['iban'],
-                            'unique_reference': unique_reference,
-                            'transaction_reference': payment_proposal_payments[0]['reference'],
-                            'party_match': party_match,
-                            'invoice_matches': invoice_match,
-                            'matched_amount': matched_amount
-                        }
-                        txns.append(new_txn)
-                    else:
-                        # not matched against payment instruction
-                        new_txn = {
-                            'txid': len(txns),
-                            'date': date,
-                            'currency': entry_currency,
-                            'amount': entry_amount,
-                            'party_name': "???",
-                            'party_address': "???",
-                            'credit_debit': credit_debit,
-                            'party_iban': "???",
-                            'unique_reference': unique_reference,
-                            'transaction_reference': unique_reference,
-                            'party_match': None,
-                            'invoice_matches': None,
-                            'matched_amount': None
-                        }
-                        txns.append(new_txn)
-                except Exception as err:
-                    # no payment instruction
-                    new_txn = {
-                        'txid': len(txns),
-                        'date': date,
-                        'currency': entry_currency,
-                        'amount': entry_amount,
-                        'party_name': "???",
-                        'party_address': "???",
-                        'credit_debit': credit_debit,
-                        'party_iban': "???",
-                        'unique_reference': unique_reference,
-                        'transaction_reference': unique_reference,
-                        'party_match': None,
-                        'invoice_matches': None,
-                        'matched_amount': None
-                    }
-                    txns.append(new_txn)
+                    # fallback to hash
+                    code = "{0}:{1}:{2}".format(date, entry_currency, entry_amount)
+                    unique_reference = hashlib.md5(code.encode("utf-8")).hexdigest()
+        # --- find transaction type: paid or received: (DBIT: paid, CRDT: received)
+        credit_debit = entry.cdtdbtind.get_text()
+        # find payment instruction ID
+        try:
+            # instruction ID, PMTINF-[payment proposal]-row
+            payment_instruction = parse_payment_instruction_id(entry.pmtinfid.get_text())
+        except Exception:
+            # no payment instruction
+            payment_instruction = None
+        txns.append({
+            'txid': None,
+            'date': date,
+            'currency': entry_currency,
+            'amount': entry_amount,
+            'party_name': "???",
+            'party_address': "???",
+            'credit_debit': credit_debit,
+            'party_iban': "???",
+            'unique_reference': unique_reference,
+            'transaction_reference': unique_reference,
+            'payment_instruction': payment_instruction
+        })
     return txns
 
 
+def match_transaction(txn, snapshot):
+    """Find matching parties & documents of a parsed transaction in the snapshot."""
+    if 'payment_instruction' in txn:
+        return match_payment_instruction(txn, snapshot)
+
+    credit_debit = txn['credit_debit']
+    party_name = txn['party_name']
+    transaction_reference = txn['transaction_reference']
+    currency = txn['currency']
+    date = txn['date']
+
+    # try to find matching parties & invoices
+    party_match = None
+    employee_match = None
+    invoice_matches = None
+    expense_matches = None
+    matched_amount = 0.0
+    if credit_debit == "DBIT":
+        # suppliers 
+        party_match = snapshot['suppliers'].get(party_name)
+        if party_match:
+            # restrict pins to supplier
+            possible_pinvs = [pinv for pinv in snapshot['purchase_invoices'] if pinv['supplier'] == party_match]
+        else:
+            # purchase invoices
+            possible_pinvs = snapshot['purchase_invoices']
+        if possible_pinvs:
+            invoice_matches = []
+            for pinv in possible_pinvs:
+                if pinv['name'] in transaction_reference or (pinv['bill_no'] or pinv['name']) in transaction_reference:
+                    invoice_matches.append(pinv['name'])
+                    # override party match in case there is one from the sales invoice
+                    party_match = pinv['supplier']
+                    # add total matched amount
+                    matched_amount = add_matched_amount(matched_amount, convert_outstanding_amount(snapshot,
+                        pinv['outstanding_amount'], pinv['party_account_currency'], currency, date))
+        # employees 
+        employee_match = snapshot['employees'].get(party_name)
+        # expense claims
+        possible_expenses = snapshot['expense_claims']
+        if possible_expenses:
+            expense_matches = []
+            for exp in possible_expenses:
+                if exp['name'] in transaction_reference:
+                    expense_matches.append(exp['name'])
+                    # override party match in case there is one from the sales invoice
+                    employee_match = exp['employee']
+                    # add total matched amount
+                    matched_amount = add_matched_amount(matched_amount, convert_outstanding_amount(snapshot,
+                        exp['total_claimed_amount'], snapshot['company_currency'], currency, date))
+    else:
+        # customers & sales invoices
+        party_match = snapshot['customers'].get(party_name)
+        # sales invoices
+        possible_sinvs = snapshot['sales_invoices']
+        if possible_sinvs:
+            invoice_matches = []
+            for sinv in possible_sinvs:
+                if sinv['name'] in transaction_reference:
+                    invoice_matches.append(sinv['name'])
+                    # override party match in case there is one from the sales invoice
+                    party_match = sinv['customer']
+                    # add total matched amount
+                    matched_amount = add_matched_amount(matched_amount, convert_outstanding_amount(snapshot,
+                        sinv['outstanding_amount'], sinv['party_account_currency'], currency, date))
+
+    # reset invoice matches in case there are no matches
+    txn.update({
+        'party_match': party_match,
+        'invoice_matches': invoice_matches or None,
+        'matched_amount': round(matched_amount, 2) if matched_amount is not None else None,
+        'employee_match': employee_match,
+        'expense_matches': expense_matches or None,
+        'exchange_rate': get_transaction_exchange_rate(txn, snapshot)
+    })
+    txn['confidence'] = get_match_confidence(txn, snapshot)
+    return txn
+
+
+def get_transaction_exchange_rate(txn, snapshot):
+    """Return the exchange rate from the transaction to the company currency."""
+    if not snapshot['company_currency']:
+        return 1.0
+    return get_cached_exchange_rate(snapshot, txn['currency'], snapshot['company_currency'], txn['date'])
+
+
+def match_payment_instruction(txn, snapshot):
+    """Match a transaction without TxDtls against its original payment proposal."""
+    payment_instruction = txn.pop('payment_instruction')
+    txn['exchange_rate'] = get_transaction_exchange_rate(txn, snapshot)
+    # find original instruction record
+    payment_proposal_payment = snapshot['payment_proposal_payments'].get(payment_instruction)
+    if not payment_proposal_payment:
+        # not matched against payment instruction
+        txn.update({
+            'party_match': None,
+            'invoice_matches': None,
+            'matched_amount': None,
+            'confidence': 0
+        })
+        return txn
+
+    # suppliers 
+    party_match = snapshot['proposal_suppliers'].get(payment_proposal_payment['receiver'])
+    # purchase invoices 
+    invoice_match = None
+    matched_amount = 0
+    if payment_proposal_payment['reference'] in snapshot['purchase_invoice_totals']:
+        invoice_match = [payment_proposal_payment['reference']]
+        matched_amount = snapshot['purchase_invoice_totals'][payment_proposal_payment['reference']]
+
+    txn.update({
+        'party_name': payment_proposal_payment['receiver'],
+        'party_address': "{0}, {1}".format(
+            payment_proposal_payment['receiver_address_line1'], 
+            payment_proposal_payment['receiver_address_line2']),
+        'party_iban': payment_proposal_payment['iban'],
+        'transaction_reference': payment_proposal_payment['reference'],
+        'party_match': party_match,
+        'invoice_matches': invoice_match,
+        'matched_amount': matched_amount
+    })
+    txn['confidence'] = get_match_confidence(txn, snapshot)
+    return txn
+
+
+def get_match_confidence(txn, snapshot):
+    """Score a matched transaction from 0 to 100.
+
+    Each agreement of the transaction with its matched documents adds its
+    weight from CONFIDENCE_WEIGHTS:
+    - reference: the reference names open invoices or expense claims
+    - amount: the amount equals the matched outstanding amount
+    - party: the party name resolves to the matched party
+    - iban: the party IBAN belongs to the matched party
+    """
+    confidence = 0
+    if txn.get('invoice_matches') or txn.get('expense_matches'):
+        confidence += CONFIDENCE_WEIGHTS['reference']
+    if txn.get('matched_amount') and abs(flt(txn['amount']) - flt(txn['matched_amount'])) < 0.005:
+        confidence += CONFIDENCE_WEIGHTS['amount']
+
+    if txn['credit_debit'] == "DBIT" and txn.get('expense_matches'):
+        party_type, party = "Employee", txn.get('employee_match')
+        name_party = snapshot['employees'].get(txn['party_name'])
+    elif txn['credit_debit'] == "DBIT":
+        party_type, party = "Supplier", txn.get('party_match')
+        name_party = snapshot['suppliers'].get(txn['party_name'],
+            snapshot['proposal_suppliers'].get(txn['party_name']))
+    else:
+        party_type, party = "Customer", txn.get('party_match')
+        name_party = snapshot['customers'].get(txn['party_name'])
+
+    if party and name_party == party:
+        confidence += CONFIDENCE_WEIGHTS['party']
+    if party and snapshot['party_ibans'].get(normalize_iban(txn.get('party_iban'))) == (party_type, party):
+        confidence += CONFIDENCE_WEIGHTS['iban']
+    return confidence
+
+
+def auto_reconcile_transactions(txns, bank_account, threshold):
+    """Book all invoice matches with a confidence of at least threshold.
+
+    All payment entries are created and submitted in one database transaction.
+    Each booking runs in its own savepoint, a failing booking is logged and
+    its transaction returned to the wizard. An invoice is only booked once per
+    statement, further transactions matching it are left to the user. Return
+    the transactions which were not booked.
+    """
+    try:
+        defaults = get_defaults(bank_account)
+    except frappe.DoesNotExistError:
+        # no Bank Utils Defaults for the company, the user books the transactions
+        return txns
+
+    remaining_txns = []
+    reconciled_invoices = set()
+    reconciled = 0
+    for txn in txns:
+        if not is_auto_reconcilable(txn, threshold) or reconciled_invoices.intersection(txn['invoice_matches']):
+            remaining_txns.append(txn)
+            continue
+
+        message_count = len(frappe.local.message_log)
+        frappe.db.sql("savepoint auto_reconcile")
+        try:
+            make_payment_entry(**get_auto_reconcile_payment(txn, bank_account, defaults))
+            reconciled_invoices.update(txn['invoice_matches'])
+            reconciled += 1
+        except Exception:
+            frappe.db.rollback(save_point="auto_reconcile")
+            # the failure is handled, its message only goes to the Error Log
+            del frappe.local.message_log[message_count:]
+            frappe.log_error(frappe.get_traceback(),
+                "Auto reconciliation of {0} failed".format(txn['unique_reference']))
+            remaining_txns.append(txn)
+
+    if reconciled:
+        frappe.db.commit()
+        frappe.msgprint(_("{0} transactions were reconciled automatically").format(reconciled), alert=True)
+
+    return remaining_txns
+
+
+def is_auto_reconcilable(txn, threshold):
+    """Only invoice matches with a known party and exchange rate are booked."""
+    return bool(txn.get('invoice_matches')
+        and not txn.get('expense_matches')
+        and txn.get('party_match')
+        and txn.get('exchange_rate')
+        and flt(txn.get('confidence')) >= flt(threshold))
+
+
+def get_auto_reconcile_payment(txn, bank_account, defaults):
+    """Return the make_payment_entry arguments the wizard would use for txn."""
+    payment = {
+        'amount': txn['amount'],
+        'date': txn['date'],
+        'reference_no': txn['unique_reference'],
+        'remarks': "{0}, {1}, {2}".format(txn['transaction_reference'], txn['party_name'], txn['party_address']),
+        'company': defaults['company'],
+        'exchange_rate': txn['exchange_rate'],
+        'currency': txn['currency'],
+        'party': txn['party_match'],
+        'references': txn['invoice_matches'],
+        'auto_submit': True
+    }
+    if txn['credit_debit'] == "DBIT":
+        payment.update({
+            'payment_type': 'Pay',
+            'party_type': 'Supplier',
+            'paid_from': bank_account,
+            'paid_to': defaults['default_payable_account']
+        })
+    else:
+        payment.update({
+            'payment_type': 'Receive',
+            'party_type': 'Customer',
+            'paid_from': defaults['default_receivable_account'],
+            'paid_to': bank_account
+        })
+    return payment
+
+
+@frappe.whitelist()
+def export_camt053(content, bank_account=None, file_format="csv"):
+    """Stream the new transactions of a statement and their matches as CSV or XLSX.
+
+    The database is only read before streaming: a first pass over the entries
+    collects the keys of the match snapshots and the recorded references. The
+    rows are parsed, matched and written in a second pass while the response
+    is sent, without keeping the transactions in memory. The parsed document
+    itself is kept until the response is complete, so memory grows with the
+    size of the uploaded file, but not with the transactions and matches.
+    """
+    soup = BeautifulSoup(content, 'lxml')
+    statements = []
+    for statement_account, entries in get_statement_entries(soup, bank_account):
+        company = frappe.get_cached_value("Account", statement_account, "company") if statement_account else None
+        keys = get_match_keys([])
+        references = set()
+        for entry in entries:
+            txns = read_camt_entry(entry)
+            get_match_keys(txns, keys)
+            references.update(txn['unique_reference'] for txn in txns)
+        statements.append((statement_account, entries, load_match_snapshot(keys, company),
+            get_imported_references(references)))
+
+    header = [_(label) for label, fieldname in EXPORT_COLUMNS]
+    rows = iter_export_rows(statements)
+    if file_format == "xlsx":
+        body = stream_xlsx(header, rows, _("Transactions"))
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        file_format = "csv"
+        body = stream_csv(header, rows)
+        mimetype = "text/csv"
+
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.headers["Content-Disposition"] = 'attachment; filename="bank_statement.{0}"'.format(file_format)
+    return response
+
+
+def iter_export_rows(statements):
+    """Yield an export row for each new transaction of the statements.
+
+    This runs while the response is streamed and must not access the database.
+    """
+    txid = 0
+    for bank_account, entries, snapshot, imported_references in statements:
+        for entry in entries:
+            for txn in read_camt_entry(entry):
+                if txn['unique_reference'] in imported_references:
+                    continue
+                txn['txid'] = txid
+                txn['bank_account'] = bank_account
+                txid += 1
+                match_transaction(txn, snapshot)
+                yield [get_export_value(txn.get(fieldname)) for label, fieldname in EXPORT_COLUMNS]
+
+
+def get_export_value(value):
+    if isinstance(value, (list, tuple)):
+        return ", ".join(value)
+    return value
+
+
+def stream_csv(header, rows):
+    """Write the rows as CSV, yielding UTF-8 encoded chunks of EXPORT_CHUNK_ROWS rows.
+
+    The response is passed through directly, so the chunks must be bytes.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_xlsx(header, rows, title):
+    """Write the rows to a write-only workbook and stream the saved file.
+
+    An XLSX file is a zip archive which can only be sent once it is complete.
+    The write-only workbook keeps the rows in temporary files, not in memory.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+
+    with tempfile.TemporaryFile() as xlsx_file:
+        workbook.save(xlsx_file)
+        xlsx_file.seek(0)
+        chunk = xlsx_file.read(EXPORT_CHUNK_BYTES)
+        while chunk:
+            yield chunk
+            chunk = xlsx_file.read(EXPORT_CHUNK_BYTES)
+
+
 @frappe.whitelist()
 def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None, payment_type=None, 
-    party=None, party_type=None, references=None, remarks=None, auto_submit=False, exchange_rate=1,
-    company=None):
+    party=None, party_type=None, references=None, remarks=None, auto_submit=False, exchange_rate=None,
+    company=None, currency=None):
     # assert list
-    if references:
+    if references and isinstance(references, str):
         references = ast.literal_eval(references)
 
     reference_type = "Sales Invoice"
@@ -514,6 +1296,11 @@ def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None,
         elif paid_to:
             company = frappe.get_value("Account", paid_to, "company")
 
+    # the bank account is booked in the transaction currency
+    exchange_rate = get_payment_exchange_rate(exchange_rate, currency, company, date)
+    paid_amount, source_exchange_rate = get_account_amount(paid_from, amount, exchange_rate, company)
+    received_amount, target_exchange_rate = get_account_amount(paid_to, amount, exchange_rate, company)
+
     if payment_type == "Receive":
         # receive
         payment_entry = frappe.get_doc({
@@ -522,16 +1309,16 @@ def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None,
             'party_type': party_type,
             'party': party,
             'paid_to': paid_to,
-            'paid_amount': float(amount),
-            'received_amount': float(amount),
+            'paid_amount': paid_amount,
+            'received_amount': received_amount,
             'reference_no': reference_no,
             'reference_date': date,
             'posting_date': date,
             'remarks': remarks,
             'camt_amount': float(amount),
             'company': company,
-            'source_exchange_rate': exchange_rate,
-            'target_exchange_rate': exchange_rate
+            'source_exchange_rate': source_exchange_rate,
+            'target_exchange_rate': target_exchange_rate
         })
     elif payment_type == "Pay":
         # pay
@@ -541,16 +1328,16 @@ def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None,
             'party_type': party_type,
             'party': party,
             'paid_from': paid_from,
-            'paid_amount': float(amount),
-            'received_amount': float(amount),
+            'paid_amount': paid_amount,
+            'received_amount': received_amount,
             'reference_no': reference_no,
             'reference_date': date,
             'posting_date': date,
             'remarks': remarks,
             'camt_amount': float(amount),
             'company': company,
-            'source_exchange_rate': exchange_rate,
-            'target_exchange_rate': exchange_rate
+            'source_exchange_rate': source_exchange_rate,
+            'target_exchange_rate': target_exchange_rate
         })
         if party_type == "Employee":
             reference_type = "Expense Claim"
@@ -563,16 +1350,16 @@ def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None,
             'payment_type': 'Internal Transfer',
             'paid_from': paid_from,
             'paid_to': paid_to,
-            'paid_amount': float(amount),
-            'received_amount': float(amount),
+            'paid_amount': paid_amount,
+            'received_amount': received_amount,
             'reference_no': reference_no,
             'reference_date': date,
             'posting_date': date,
             'remarks': remarks,
             'camt_amount': float(amount),
             'company': company,
-            'source_exchange_rate': exchange_rate,
-            'target_exchange_rate': exchange_rate
+            'source_exchange_rate': source_exchange_rate,
+            'target_exchange_rate': target_exchange_rate
         })
     else:
         frappe.throw(_('No Payment Type specified!'))
@@ -594,6 +1381,42 @@ def make_payment_entry(amount, date, reference_no, paid_from=None, paid_to=None,
     return new_entry.name
 
 
+def get_payment_exchange_rate(exchange_rate, currency, company, date):
+    """Return the exchange rate from the transaction currency to the company currency.
+
+    Without exchange_rate, the rate is taken from ERPNext. A missing rate stops
+    the booking instead of booking at rate 1. Without currency, the transaction
+    is in company currency.
+    """
+    if flt(exchange_rate):
+        return flt(exchange_rate)
+
+    company_currency = frappe.get_cached_value("Company", company, "default_currency")
+    if not currency or currency == company_currency:
+        return 1
+
+    from erpnext.setup.utils import get_exchange_rate
+
+    exchange_rate = flt(get_exchange_rate(currency, company_currency, date))
+    if not exchange_rate:
+        frappe.throw(_("No exchange rate from {0} to {1} on {2}").format(currency, company_currency, date))
+    return exchange_rate
+
+
+def get_account_amount(account, amount, exchange_rate, company):
+    """Return (amount, exchange rate) of a payment in the currency of account.
+
+    Accounts in company currency get the converted amount at rate 1.
+    """
+    amount = float(amount)
+    if exchange_rate == 1 or not account:
+        return amount, exchange_rate
+    account_currency = frappe.get_cached_value("Account", account, "account_currency")
+    if account_currency == frappe.get_cached_value("Company", company, "default_currency"):
+        return flt(amount * exchange_rate, 2), 1
+    return amount, exchange_rate
+
+
 def create_reference(payment_entry, invoice_reference, invoice_type="Sales Invoice"):
     """Create a reference record in a Payment Entry."""
     reference_entry = frappe.get_doc({"doctype": "Payment Entry Reference"})
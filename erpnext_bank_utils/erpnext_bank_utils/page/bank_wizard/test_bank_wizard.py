@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ALYF GmbH and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import unittest
+from unittest.mock import patch
+from bs4 import BeautifulSoup
+
+import frappe
+from frappe.utils import cint
+from erpnext_bank_utils.install import LOOKUP_INDEXES, add_lookup_indexes
+from erpnext_bank_utils.party_memo import clear_party_memo, get_party_memo
+from erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard import bank_wizard
+from erpnext_bank_utils.erpnext_bank_utils.page.bank_wizard.bank_wizard import read_camt_transactions
+
+# upper bound of the queries for reading a statement, independent of its size
+MAX_QUERIES = 15
+
+ENTRY = """<Ntry>
+	<Amt Ccy="CHF">{amount}</Amt>
+	<CdtDbtInd>{credit_debit}</CdtDbtInd>
+	<BookgDt><Dt>2021-05-{day:02d}</Dt></BookgDt>
+	<AcctSvcrRef>TEST-BANK-WIZARD-{idx}</AcctSvcrRef>
+	<NtryDtls><TxDtls>
+		<Refs><EndToEndId>TEST-BANK-WIZARD-E2E-{idx}</EndToEndId></Refs>
+		<RltdPties>
+			<Dbtr><Nm>Test Debtor {party}</Nm></Dbtr>
+			<DbtrAcct><Id><IBAN>CH00TEST{idx:08d}</IBAN></Id></DbtrAcct>
+			<Cdtr><Nm>Test Creditor {party}</Nm></Cdtr>
+			<CdtrAcct><Id><IBAN>CH00TEST{idx:08d}</IBAN></Id></CdtrAcct>
+		</RltdPties>
+		<RmtInf><Ustrd>Test payment {idx}</Ustrd></RmtInf>
+	</TxDtls></NtryDtls>
+</Ntry>"""
+
+
+def get_statement_entries(count):
+	"""Return the <Ntry> elements of a synthetic camt.053 statement."""
+	content = "<Document><BkToCstmrStmt><Stmt>{0}</Stmt></BkToCstmrStmt></Document>".format("".join(
+		ENTRY.format(amount=100 + idx, credit_debit="DBIT" if idx % 2 else "CRDT",
+			day=1 + idx % 28, idx=idx, party=idx % 10)
+		for idx in range(count)
+	))
+	return BeautifulSoup(content, 'lxml').find_all('ntry')
+
+
+def get_snapshot(**values):
+	"""Return an empty match snapshot of a CHF company, updated with values."""
+	snapshot = {
+		'suppliers': {},
+		'proposal_suppliers': {},
+		'customers': {},
+		'employees': {},
+		'purchase_invoices': [],
+		'purchase_invoice_totals': {},
+		'sales_invoices': [],
+		'expense_claims': [],
+		'payment_proposal_payments': {},
+		'party_ibans': {},
+		'company_currency': "CHF",
+		'exchange_rates': {}
+	}
+	snapshot.update(values)
+	return snapshot
+
+
+def get_transaction(**values):
+	"""Return a parsed transaction, updated with values."""
+	txn = {
+		'txid': 0,
+		'date': "2021-05-10",
+		'currency': "CHF",
+		'amount': 100.0,
+		'credit_debit': "CRDT",
+		'party_name': "Test Customer",
+		'party_address': "",
+		'party_iban': None,
+		'unique_reference': "TEST-BANK-WIZARD",
+		'transaction_reference': "TEST-BANK-WIZARD"
+	}
+	txn.update(values)
+	return txn
+
+
+def get_entry_indexes(entries):
+	"""Return the idx of the AcctSvcrRef of each entry."""
+	return [entry.acctsvcrref.get_text().rsplit("-", 1)[-1] for entry in entries]
+
+
+def get_test_supplier(supplier_name):
+	"""Return an enabled Supplier of supplier_name."""
+	supplier = frappe.db.get_value("Supplier", {"supplier_name": supplier_name})
+	if supplier:
+		supplier = frappe.get_doc("Supplier", supplier)
+	else:
+		supplier = frappe.get_doc({
+			"doctype": "Supplier",
+			"supplier_name": supplier_name,
+			"supplier_group": frappe.db.get_value("Supplier Group", {"is_group": 0})
+		}).insert()
+	if supplier.disabled:
+		supplier.disabled = 0
+		supplier.save()
+	return supplier
+
+
+def get_test_bank_account(account_name, iban, **values):
+	"""Return a Bank Account with values, its IBAN stored with spaces as typed by users."""
+	if not frappe.db.exists("Bank", "Test Bank Wizard Bank"):
+		frappe.get_doc({"doctype": "Bank", "bank_name": "Test Bank Wizard Bank"}).insert()
+
+	bank_account = frappe.db.get_value("Bank Account", {"account_name": account_name})
+	if bank_account:
+		bank_account = frappe.get_doc("Bank Account", bank_account)
+	else:
+		bank_account = frappe.get_doc({
+			"doctype": "Bank Account",
+			"account_name": account_name,
+			"bank": "Test Bank Wizard Bank"
+		})
+	bank_account.update(values)
+	bank_account.iban = iban
+	bank_account.save()
+	return bank_account
+
+
+def get_routed_statements(statements, bank_account):
+	"""Return the (bank account, entries) of a camt.053 document of the statements."""
+	content = "<Document><BkToCstmrStmt>{0}</BkToCstmrStmt></Document>".format("".join(statements))
+	return bank_wizard.get_statement_entries(BeautifulSoup(content, 'lxml'), bank_account)
+
+
+def get_rows_scanned():
+	"""Return the rows read by full table scans in this session."""
+	return sum(cint(row[1]) for row in frappe.db.sql("show session status like 'Handler_read_rnd_next'"))
+
+
+class TestBankWizard(unittest.TestCase):
+	def setUp(self):
+		add_lookup_indexes()
+		# load the meta data of the matched doctypes before counting
+		read_camt_transactions(get_statement_entries(1), processes=1)
+
+	def test_lookup_indexes(self):
+		for doctype, fields in LOOKUP_INDEXES:
+			index_name = "_".join(fields) + "_index"
+			self.assertTrue(frappe.db.has_index("tab" + doctype, index_name),
+				"{0} has no index on {1}".format(doctype, ", ".join(fields)))
+
+	def test_query_count(self):
+		query_counts = []
+		for count in (10, 200):
+			entries = get_statement_entries(count)
+			clear_party_memo()
+			with patch.object(frappe.db, "sql", wraps=frappe.db.sql) as sql:
+				txns = read_camt_transactions(entries, processes=1)
+			self.assertEqual(len(txns), count)
+			query_counts.append(sql.call_count)
+
+		# the number of queries must not depend on the number of transactions
+		self.assertEqual(query_counts[0], query_counts[1])
+		self.assertLessEqual(query_counts[1], MAX_QUERIES)
+
+	def test_match_processes(self):
+		entries = get_statement_entries(40)
+		serial_txns = read_camt_transactions(entries, processes=1)
+		with patch.object(bank_wizard, "MIN_PARALLEL_TRANSACTIONS", 1):
+			parallel_txns = read_camt_transactions(entries, processes=2)
+
+		# the process pool matches exactly like the serial path, in statement order
+		self.assertEqual(serial_txns, parallel_txns)
+
+	def test_exchange_rate(self):
+		sales_invoices = [{'name': "SINV-TEST-1", 'customer': "CUST-TEST", 'outstanding_amount': 108.0,
+			'party_account_currency': "CHF"}]
+		txn = get_transaction(currency="EUR", transaction_reference="Invoice SINV-TEST-1")
+
+		# a rate older than the transaction is used, the invoice is converted to EUR
+		snapshot = get_snapshot(sales_invoices=sales_invoices,
+			exchange_rates={("EUR", "CHF"): [("2021-05-01", 1.08), ("2021-05-20", 1.2)]})
+		matched_txn = bank_wizard.match_transaction(dict(txn), snapshot)
+		self.assertEqual(matched_txn['exchange_rate'], 1.08)
+		self.assertEqual(matched_txn['matched_amount'], 100.0)
+		self.assertEqual(matched_txn['invoice_matches'], ["SINV-TEST-1"])
+
+		# without exchange rate, CHF is not compared with EUR
+		matched_txn = bank_wizard.match_transaction(dict(txn), get_snapshot(sales_invoices=sales_invoices))
+		self.assertIsNone(matched_txn['exchange_rate'])
+		self.assertIsNone(matched_txn['matched_amount'])
+		self.assertEqual(matched_txn['invoice_matches'], ["SINV-TEST-1"])
+
+	def test_payment_exchange_rate(self):
+		with patch.object(frappe, "get_cached_value", return_value="CHF"), \
+				patch("erpnext.setup.utils.get_exchange_rate", return_value=0):
+			self.assertEqual(bank_wizard.get_payment_exchange_rate(1.08, "EUR", "Test Company", "2021-05-10"), 1.08)
+			self.assertEqual(bank_wizard.get_payment_exchange_rate(None, "CHF", "Test Company", "2021-05-10"), 1)
+
+			# a EUR line without exchange rate is not booked at rate 1
+			self.assertRaises(frappe.ValidationError, bank_wizard.get_payment_exchange_rate,
+				None, "EUR", "Test Company", "2021-05-10")
+
+	def test_party_iban(self):
+		supplier = get_test_supplier("Test Creditor 1")
+		get_test_bank_account("Test Bank Wizard Supplier", "CH93 0076 2011 6238 5295 7",
+			party_type="Supplier", party=supplier.name)
+		clear_party_memo()
+
+		# the IBAN of the statement is found although it is stored with spaces
+		txn = get_transaction(credit_debit="DBIT", party_name="Test Creditor 1", party_iban="CH9300762011623852957")
+		snapshot = bank_wizard.load_match_snapshot(bank_wizard.get_match_keys([txn]))
+		self.assertEqual(snapshot['party_ibans'], {"CH9300762011623852957": ("Supplier", supplier.name)})
+		self.assertEqual(bank_wizard.match_transaction(txn, snapshot)['confidence'], 30)
+
+	def test_auto_reconcile(self):
+		txn = get_transaction(transaction_reference="Invoice SINV-TEST-1", party_iban="CH00TEST00000001")
+		snapshot = get_snapshot(customers={"Test Customer": "CUST-TEST"},
+			party_ibans={"CH00TEST00000001": ("Customer", "CUST-TEST")},
+			sales_invoices=[{'name': "SINV-TEST-1", 'customer': "CUST-TEST", 'outstanding_amount': 100.0,
+				'party_account_currency': "CHF"}])
+
+		# reference, amount, party and IBAN agree
+		matched_txn = bank_wizard.match_transaction(dict(txn), snapshot)
+		self.assertEqual(matched_txn['confidence'], 100)
+		self.assertTrue(bank_wizard.is_auto_reconcilable(matched_txn, 100))
+
+		# a different amount lowers the confidence below the threshold
+		matched_txn = bank_wizard.match_transaction(dict(txn, amount=90.0), snapshot)
+		self.assertEqual(matched_txn['confidence'], 70)
+		self.assertFalse(bank_wizard.is_auto_reconcilable(matched_txn, 100))
+		self.assertTrue(bank_wizard.is_auto_reconcilable(matched_txn, 70))
+
+		# a failed booking is returned to the wizard, its message is only logged
+		defaults = {'company': "Test Company", 'default_payable_account': None, 'default_receivable_account': None}
+		message_count = len(frappe.local.message_log)
+		with patch.object(bank_wizard, "get_defaults", return_value=defaults), \
+				patch.object(bank_wizard, "make_payment_entry", side_effect=lambda **kwargs: frappe.throw("Test booking failed")):
+			txns = bank_wizard.auto_reconcile_transactions([matched_txn], "Test Bank Account", 0)
+		self.assertEqual(txns, [matched_txn])
+		self.assertEqual(len(frappe.local.message_log), message_count)
+
+		# without Bank Utils Defaults, nothing is booked and all transactions are returned
+		with patch.object(bank_wizard, "get_defaults", side_effect=frappe.DoesNotExistError), \
+				patch.object(bank_wizard, "make_payment_entry") as make_payment_entry:
+			txns = bank_wizard.auto_reconcile_transactions([matched_txn], "Test Bank Account", 0)
+		self.assertEqual(txns, [matched_txn])
+		make_payment_entry.assert_not_called()
+
+	def test_watermark(self):
+		# A and B are booked on 05-05 in statement order, C on 05-06
+		entries = BeautifulSoup("".join(
+			ENTRY.format(amount=100, credit_debit="CRDT", day=day, idx=idx, party=0)
+			for idx, day in ((0, 4), (1, 5), (2, 5), (3, 6))
+		), 'lxml').find_all('ntry')
+
+		# the statement the watermark was set from only had A, B is kept
+		watermark = frappe._dict(booking_date="2021-05-05", account_servicer_reference="TEST-BANK-WIZARD-1")
+		self.assertEqual(get_entry_indexes(bank_wizard.skip_watermarked_entries(entries, watermark)), ["2", "3"])
+
+		watermark.account_servicer_reference = "TEST-BANK-WIZARD-2"
+		self.assertEqual(get_entry_indexes(bank_wizard.skip_watermarked_entries(entries, watermark)), ["3"])
+
+		# no overlap with the statement of the watermark, the whole date is kept
+		watermark.account_servicer_reference = "OTHER-BANK-REFERENCE"
+		self.assertEqual(get_entry_indexes(bank_wizard.skip_watermarked_entries(entries, watermark)), ["1", "2", "3"])
+
+	def test_statement_routing(self):
+		ledgers = frappe.get_all("Account", filters={'account_type': "Bank", 'is_group': 0},
+			fields=['name', 'company'], limit=2)
+		if len(ledgers) < 2:
+			self.skipTest("two bank accounts are needed")
+		# company Bank Accounts, their IBANs stored with spaces
+		for ledger, iban in zip(ledgers, ("GB82 WEST 1234 5698 7654 32", "DE89 3704 0044 0532 0130 00")):
+			get_test_bank_account("Test Bank Wizard " + ledger['name'], iban,
+				is_company_account=1, account=ledger['name'], company=ledger['company'])
+
+		statement = """<Stmt>
+			<Acct><Id><IBAN>{iban}</IBAN></Id></Acct>
+			{entries}
+		</Stmt>"""
+		statements = [
+			statement.format(iban="GB82WEST12345698765432", entries="".join(
+				ENTRY.format(amount=100, credit_debit="CRDT", day=1, idx=idx, party=0) for idx in (0, 1))),
+			statement.format(iban="de89370400440532013000", entries=ENTRY.format(
+				amount=100, credit_debit="CRDT", day=1, idx=2, party=0).replace(
+				"<Dt>2021-05-01</Dt>", "<DtTm>2021-05-01T10:15:00</DtTm>")),
+			statement.format(iban="CH5604835012345678009", entries=ENTRY.format(
+				amount=100, credit_debit="CRDT", day=1, idx=3, party=0))
+		]
+
+		# each statement is routed to the account of its IBAN, the unknown IBAN is skipped
+		routed_statements = get_routed_statements(statements, "Test Bank 0")
+		self.assertEqual([(account, get_entry_indexes(entries)) for account, entries in routed_statements],
+			[(ledgers[0]['name'], ["0", "1"]), (ledgers[1]['name'], ["2"])])
+
+		# the booking date of an intraday booking is read from DtTm
+		self.assertEqual(bank_wizard.get_entry_booking(routed_statements[1][1][0]),
+			("2021-05-01", "TEST-BANK-WIZARD-2"))
+
+		# a single statement of an unknown IBAN is read for the selected account
+		self.assertEqual([(account, get_entry_indexes(entries))
+			for account, entries in get_routed_statements(statements[2:], "Test Bank 0")], [("Test Bank 0", ["3"])])
+
+	def test_export(self):
+		header = ["Date", "Party"]
+		rows = [["2021-05-{0:02d}".format(day), "Test Customer Zürich"] for day in range(1, 29)]
+		with patch.object(bank_wizard, "EXPORT_CHUNK_ROWS", 10):
+			chunks = list(bank_wizard.stream_csv(header, iter(rows)))
+
+		# WSGI only passes bytes through
+		self.assertEqual(len(chunks), 3)
+		self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+		lines = b"".join(chunks).decode("utf-8").splitlines()
+		self.assertEqual(lines[0], "Date,Party")
+		self.assertEqual(lines[1:], [",".join(row) for row in rows])
+
+	def test_rows_scanned(self):
+		rows_scanned = []
+		for count in (10, 200):
+			entries = get_statement_entries(count)
+			clear_party_memo()
+			before = get_rows_scanned()
+			read_camt_transactions(entries, processes=1)
+			rows_scanned.append(get_rows_scanned() - before)
+
+		# full table scans depend on the data of the site, but not on the size of the statement
+		self.assertEqual(rows_scanned[0], rows_scanned[1])
+
+	def test_party_memo(self):
+		entries = get_statement_entries(20)
+		clear_party_memo()
+		read_camt_transactions(entries, processes=1)
+		with patch.object(frappe.db, "sql", wraps=frappe.db.sql) as sql:
+			read_camt_transactions(entries, processes=1)
+
+		# recurring counterparties are resolved without querying the parties
+		for doctype in ("Supplier", "Customer", "Employee", "Bank Account"):
+			self.assertFalse([call for call in sql.call_args_list if "`tab{0}`".format(doctype) in str(call)],
+				"{0} was queried for known counterparties".format(doctype))
+
+	def test_party_memo_invalidation(self):
+		supplier = get_test_supplier("Test Creditor 1")
+		entries = get_statement_entries(2)
+		clear_party_memo()
+		txns = read_camt_transactions(entries, processes=1)
+		self.assertEqual(txns[1]['party_match'], supplier.name)
+		self.assertEqual(get_party_memo(["Test Creditor 1"])["Test Creditor 1"]['parties']["Supplier"], supplier.name)
+
+		# a disabled supplier is removed from the memo and no longer matched
+		supplier.disabled = 1
+		supplier.save()
+		self.assertEqual(get_party_memo(["Test Creditor 1"]), {})
+		txns = read_camt_transactions(entries, processes=1)
+		self.assertIsNone(txns[1]['party_match'])
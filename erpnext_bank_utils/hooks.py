@@ -55,7 +55,7 @@ app_license = "AGPL v3"
 # ------------
 
 # before_install = "erpnext_bank_utils.install.before_install"
-# after_install = "erpnext_bank_utils.install.after_install"
+after_install = "erpnext_bank_utils.install.after_install"
 
 # Desk Notifications
 # ------------------
@@ -79,13 +79,27 @@ app_license = "AGPL v3"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"Supplier": {
+		"on_update": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"after_rename": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"on_trash": "erpnext_bank_utils.party_memo.invalidate_party_memo"
+	},
+	"Customer": {
+		"on_update": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"after_rename": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"on_trash": "erpnext_bank_utils.party_memo.invalidate_party_memo"
+	},
+	"Employee": {
+		"on_update": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"after_rename": "erpnext_bank_utils.party_memo.invalidate_party_memo",
+		"on_trash": "erpnext_bank_utils.party_memo.invalidate_party_memo"
+	},
+	"Bank Account": {
+		"on_update": "erpnext_bank_utils.party_memo.clear_party_memo",
+		"on_trash": "erpnext_bank_utils.party_memo.clear_party_memo"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ALYF GmbH and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+
+# indexes for the lookups of the bank wizard, (doctype, fields)
+LOOKUP_INDEXES = [
+	("Payment Entry", ["reference_no"]),
+	("Supplier", ["supplier_name"]),
+	("Customer", ["customer_name"]),
+	("Employee", ["employee_name"]),
+	("Bank Account", ["iban"]),
+	("Sales Invoice", ["outstanding_amount"]),
+	("Purchase Invoice", ["docstatus", "outstanding_amount"]),
+]
+
+
+def after_install():
+	add_lookup_indexes()
+
+
+def add_lookup_indexes():
+	"""Add the indexes of LOOKUP_INDEXES, existing indexes are kept."""
+	for doctype, fields in LOOKUP_INDEXES:
+		frappe.db.add_index(doctype, fields)
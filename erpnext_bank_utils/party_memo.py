@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Memo of the parties resolved for recurring counterparties of bank statements.
+
+The memo is a redis hash in the site cache, shared by all imports. Each field
+is a counterparty name with the parties found for it and the party of each
+IBAN used with the name:
+
+	{
+		"used": <timestamp of the last import>,
+		"parties": {"Supplier": ..., "Customer": ..., "Employee": ...},
+		"ibans": {<iban>: (<party type>, <party>) or None}
+	}
+
+The memo is bounded to PARTY_MEMO_SIZE names, the least recently used names
+are evicted first. A name is invalidated whenever a party of that name is
+saved, renamed or deleted, as are the names resolving to a renamed or deleted
+party by name or IBAN. All names are invalidated when a Bank Account changes.
+
+The memo uses plain redis commands: the methods of frappe's RedisWrapper add
+the site prefix to keys and pickle values themselves, and hdel only accepts a
+single field.
+"""
+from __future__ import unicode_literals
+import pickle
+import time
+
+import redis
+
+import frappe
+from frappe.utils.redis_wrapper import RedisWrapper
+
+PARTY_MEMO_KEY = "bank_wizard_party_memo"
+PARTY_MEMO_SIZE = 10000
+# share of the memo evicted when it is full
+PARTY_MEMO_EVICT = 0.1
+
+PARTY_NAME_FIELDS = {
+	"Supplier": "supplier_name",
+	"Customer": "customer_name",
+	"Employee": "employee_name",
+}
+
+
+def get_redis():
+	"""Return the site cache with the plain redis methods."""
+	return super(RedisWrapper, frappe.cache())
+
+
+def get_party_memo_key():
+	return frappe.cache().make_key(PARTY_MEMO_KEY)
+
+
+def get_party_memo(names):
+	"""Return a dict name: memo entry of the names found in the memo."""
+	names = list(names)
+	if not names:
+		return {}
+
+	try:
+		values = get_redis().hmget(get_party_memo_key(), names)
+	except redis.exceptions.ConnectionError:
+		# the memo is optional, redis is not available
+		return {}
+
+	return {name: pickle.loads(value) for name, value in zip(names, values) if value}
+
+
+def set_party_memo(entries):
+	"""Store the memo entries of a dict name: entry and mark them as used."""
+	if not entries:
+		return
+
+	key = get_party_memo_key()
+	used = time.time()
+	try:
+		pipeline = get_redis().pipeline()
+		for name, entry in entries.items():
+			entry["used"] = used
+			pipeline.hset(key, name, pickle.dumps(entry))
+		pipeline.execute()
+
+		if get_redis().hlen(key) > PARTY_MEMO_SIZE:
+			evict_party_memo(key)
+	except redis.exceptions.ConnectionError:
+		pass
+
+
+def evict_party_memo(key):
+	"""Remove the least recently used names of a full memo."""
+	memo = {name: pickle.loads(value) for name, value in get_redis().hgetall(key).items()}
+	names = sorted(memo, key=lambda name: memo[name]["used"])
+	count = len(names) - int(PARTY_MEMO_SIZE * (1 - PARTY_MEMO_EVICT))
+	if count > 0:
+		get_redis().hdel(key, *names[:count])
+
+
+def get_party_memo_names(key, party_type, party):
+	"""Return the names of the memo entries resolving to party, by name or IBAN."""
+	names = []
+	for name, value in get_redis().hgetall(key).items():
+		entry = pickle.loads(value)
+		if entry["parties"].get(party_type) == party or (party_type, party) in entry["ibans"].values():
+			names.append(name)
+	return names
+
+
+def invalidate_party_memo(doc, method=None, *args):
+	"""Remove the names of a Supplier, Customer or Employee from the memo.
+
+	Called from doc_events, the old name is removed as well if it changed. On
+	rename or deletion, all names resolving to the old party are removed.
+	"""
+	fieldname = PARTY_NAME_FIELDS.get(doc.doctype)
+	if not fieldname:
+		return
+
+	names = set([doc.get(fieldname)])
+	doc_before_save = doc.get_doc_before_save() if hasattr(doc, "get_doc_before_save") else None
+	if doc_before_save:
+		names.add(doc_before_save.get(fieldname))
+	names.discard(None)
+
+	if method == "after_rename":
+		# after_rename(old, new, merge)
+		old_party = args[0]
+	elif method == "on_trash":
+		old_party = doc.name
+	else:
+		old_party = None
+
+	key = get_party_memo_key()
+	try:
+		if old_party:
+			names.update(get_party_memo_names(key, doc.doctype, old_party))
+		if names:
+			get_redis().hdel(key, *names)
+	except redis.exceptions.ConnectionError:
+		pass
+
+
+def clear_party_memo(doc=None, method=None, *args):
+	"""Remove all names from the memo, called from doc_events of Bank Account."""
+	try:
+		get_redis().delete(get_party_memo_key())
+	except redis.exceptions.ConnectionError:
+		pass
@@ -0,0 +1,6 @@
+from __future__ import unicode_literals
+from erpnext_bank_utils.install import add_lookup_indexes
+
+
+def execute():
+	add_lookup_indexes()